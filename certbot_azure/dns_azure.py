@@ -1,21 +1,32 @@
 """DNS Authenticator for Azure DNS."""
+import concurrent.futures
+import functools
 import json
 import logging
 import os
+from time import sleep
 
+import requests
 import zope.interface
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import azure.core.exceptions
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import ClientSecretCredential
 from azure.mgmt.dns import DnsManagementClient
 from azure.mgmt.dns.models import RecordSet, TxtRecord
-from msrestazure.azure_exceptions import CloudError
 
 
 from certbot import errors
 from certbot import interfaces
 from certbot.plugins import dns_common
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 MSDOCS = 'https://docs.microsoft.com/'
@@ -28,8 +39,12 @@ AZURE_CLI_COMMAND = (
     " > mycredentials.json"
 )
 
+# Upper bound on concurrent record set updates, to stay clear of Azure DNS API throttling.
+MAX_WORKERS = 8
+
 
-@zope.interface.implementer(interfaces.IAuthenticator)
+# IAuthenticator is inherited from DNSAuthenticator, but class-provided interfaces are not,
+# and certbot's plugin discovery skips classes that do not provide IPluginFactory.
 @zope.interface.provider(interfaces.IPluginFactory)
 class Authenticator(dns_common.DNSAuthenticator):
     """DNS Authenticator for Azure DNS
@@ -46,6 +61,7 @@ class Authenticator(dns_common.DNSAuthenticator):
     def __init__(self, *args, **kwargs):
         super(Authenticator, self).__init__(*args, **kwargs)
         self.credentials = None
+        self._azure_client = None
 
     @classmethod
     def add_parser_arguments(cls, add):  # pylint: disable=arguments-differ
@@ -93,14 +109,116 @@ class Authenticator(dns_common.DNSAuthenticator):
 
             dns_common.validate_file_permissions(self.conf('credentials'))
 
+    def perform(self, achalls):  # pylint: disable=missing-docstring
+        self._setup_credentials()
+
+        self._attempt_cleanup = True
+
+        # Write every validation for the same name with a single record set update
+        # instead of one round-trip per challenge.
+        self._fan_out(self._get_azure_client().add_txt_records, self._group_validations(achalls), self.ttl)
+
+        logger.info("Waiting %d seconds for DNS changes to propagate",
+                    self.conf('propagation-seconds'))
+        sleep(self.conf('propagation-seconds'))
+
+        return [achall.response(achall.account_key) for achall in achalls]
+
+    def cleanup(self, achalls):  # pylint: disable=missing-docstring
+        try:
+            if self._attempt_cleanup:
+                self._fan_out(self._get_azure_client().del_txt_records, self._group_validations(achalls))
+        finally:
+            if self._azure_client is not None:
+                self._azure_client.close()
+                self._azure_client = None
+
     def _perform(self, domain, validation_name, validation):
         self._get_azure_client().add_txt_record(validation_name, validation, self.ttl)
 
     def _cleanup(self, domain, validation_name, validation):
         self._get_azure_client().del_txt_record(validation_name, validation)
 
+    @staticmethod
+    def _group_validations(achalls):
+        """
+        Group the validation contents of the given challenges by validation domain name.
+
+        :param list achalls: The annotated dns-01 challenges.
+        :returns: A mapping of validation domain name to the list of its validation contents.
+        :rtype: dict
+        """
+        groups = {}
+        for achall in achalls:
+            validation_name = achall.validation_domain_name(achall.domain)
+            validation = achall.validation(achall.account_key)
+            groups.setdefault(validation_name, []).append(validation)
+        return groups
+
+    @staticmethod
+    def _fan_out(func, groups, *args):
+        """
+        Call ``func(validation_name, validations, *args)`` for every group concurrently.
+
+        :param callable func: The record set operation to run for each group.
+        :param dict groups: A mapping of validation domain name to validation contents.
+        :raises Exception: the first exception raised by any of the calls.
+        """
+        if len(groups) <= 1:
+            # Nothing to overlap; skip spinning up worker threads.
+            for validation_name, validations in groups.items():
+                func(validation_name, validations, *args)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(func, validation_name, validations, *args)
+                       for validation_name, validations in groups.items()]
+            concurrent.futures.wait(futures)
+
+        for future in futures:
+            future.result()
+
     def _get_azure_client(self):
-        return _AzureClient(self.conf('resource-group'), self.conf('credentials'))
+        if self._azure_client is None:
+            self._azure_client = _AzureClient(self.conf('resource-group'), self.conf('credentials'))
+        return self._azure_client
+
+
+def _load_account_json(path):
+    """
+    Load an Azure service account JSON file, reusing the parsed content until the file changes.
+
+    :param str path: The path to the service account JSON file.
+    :returns: The parsed service account JSON. It is shared between callers and must not be modified.
+    :rtype: dict
+    """
+    return _parse_account_json(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_account_json(path, mtime_ns):  # pylint: disable=unused-argument
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    account_json = orjson.loads(data) if orjson is not None else json.loads(data)
+
+    # Derived client settings, computed once alongside the cached file content.
+    account_json['_base_url'] = account_json['resourceManagerEndpointUrl']
+    account_json['_credential_scopes'] = ('{}/.default'.format(account_json['_base_url']),)
+    return account_json
+
+
+@functools.lru_cache(maxsize=256)
+def _relative_name(domain, zone):
+    """
+    Get the record name of a domain relative to the zone that contains it.
+
+    :param str domain: The fqdn (typically beginning with '_acme-challenge.').
+    :param str zone: The name of the managed zone containing the domain.
+    :returns: The record name relative to the zone.
+    :rtype: str
+    """
+    return '.'.join(domain.split('.')[:-(zone.count('.') + 1)])
 
 
 class _AzureClient(object):
@@ -110,9 +228,21 @@ class _AzureClient(object):
 
     def __init__(self, resource_group, auth_path=None):
         self.resource_group = resource_group
-
-        with open(auth_path, 'r') as f:
-            account_json = json.load(f)
+        self._zone_cache = {}
+        # (domain, record_content) pairs that add_txt_records attempted to write.
+        self._written = set()
+
+        account_json = _load_account_json(auth_path)
+
+        # Keep one pooled connection per worker alive across record set updates. Only
+        # connection failures are retried here; azure-core's own retry policy handles
+        # everything that reached the server.
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MAX_WORKERS,
+            max_retries=Retry(total=3, read=False, backoff_factor=0.3)
+        ))
 
         self.dns_client = DnsManagementClient(
             ClientSecretCredential(
@@ -122,10 +252,23 @@ class _AzureClient(object):
                 authority=account_json['activeDirectoryEndpointUrl']
             ),
             account_json['subscriptionId'],
-            base_url=account_json['resourceManagerEndpointUrl'],
-            credential_scopes=['{}/.default'.format(account_json['resourceManagerEndpointUrl'])]
+            base_url=account_json['_base_url'],
+            credential_scopes=account_json['_credential_scopes'],
+            transport=RequestsTransport(session=session)
         )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying DNS management client and its HTTP connection pool.
+        """
+        self.dns_client.close()
+
     def add_txt_record(self, domain, record_content, record_ttl):
         """
         Add a TXT record using the supplied information.
@@ -135,24 +278,51 @@ class _AzureClient(object):
         :param int record_ttl: The record TTL (number of seconds that the record may be cached).
         :raises certbot.errors.PluginError: if an error occurs communicating with the Azure API
         """
+        self.add_txt_records(domain, [record_content], record_ttl)
+
+    def add_txt_records(self, domain, record_contents, record_ttl):
+        """
+        Add TXT records for all of the supplied contents with a single record set update.
+
+        :param str domain: The fqdn (typically beginning with '_acme-challenge.').
+        :param list record_contents: The record contents (typically the challenge validations).
+        :param int record_ttl: The record TTL (number of seconds that the record may be cached).
+        :raises certbot.errors.PluginError: if an error occurs communicating with the Azure API
+        """
         try:
             zone = self._find_managed_zone(domain)
-            relative_record_name = ".".join(domain.split('.')[0:-len(zone.split('.'))])
+            relative_record_name = _relative_name(domain, zone)
+            # Track the values before writing them, so a write that fails after reaching
+            # Azure is still cleaned up.
+            self._written.update((domain, record_content) for record_content in record_contents)
+            # The strings of one TxtRecord are concatenated into a single TXT value by resolvers,
+            # so every validation needs a TxtRecord of its own.
+            txt_records = [TxtRecord(value=[record_content]) for record_content in record_contents]
 
             try:
+                # Optimistically create the record set; Azure answers 412 if it already exists.
+                self.dns_client.record_sets.create_or_update(
+                    self.resource_group,
+                    zone,
+                    relative_record_name,
+                    'TXT',
+                    RecordSet(ttl=record_ttl, txt_records=txt_records),
+                    if_none_match='*',
+                    error_map={412: azure.core.exceptions.ResourceExistsError}
+                )
+            except azure.core.exceptions.ResourceExistsError:
                 record = self.dns_client.record_sets.get(self.resource_group, zone, relative_record_name, 'TXT')
-                record.txt_records.append(TxtRecord(value=[record_content]))
-            except azure.core.exceptions.ResourceNotFoundError:
-                record = RecordSet(ttl=record_ttl, txt_records=[TxtRecord(value=[record_content])])
-
-            self.dns_client.record_sets.create_or_update(
-                self.resource_group,
-                zone,
-                relative_record_name,
-                'TXT',
-                record
-            )
-        except CloudError as e:
+                record.txt_records.extend(txt_records)
+
+                self.dns_client.record_sets.create_or_update(
+                    self.resource_group,
+                    zone,
+                    relative_record_name,
+                    'TXT',
+                    record,
+                    if_match=record.etag
+                )
+        except azure.core.exceptions.HttpResponseError as e:
             logger.error('Encountered error adding TXT record: %s', e)
             raise errors.PluginError('Error communicating with the Azure DNS API: {0}'.format(e))
 
@@ -161,16 +331,37 @@ class _AzureClient(object):
         Delete a TXT record using the supplied information.
 
         :param str domain: The fqdn (typically beginning with '_acme-challenge.').
+        :param str record_content: The record content (typically the challenge validation).
         :raises certbot.errors.PluginError: if an error occurs communicating with the Azure API
         """
+        self.del_txt_records(domain, [record_content])
+
+    def del_txt_records(self, domain, record_contents):
+        """
+        Delete TXT records for all of the supplied contents with a single record set update.
+
+        :param str domain: The fqdn (typically beginning with '_acme-challenge.').
+        :param list record_contents: The record contents (typically the challenge validations).
+        :raises certbot.errors.PluginError: if an error occurs communicating with the Azure API
+        """
+        record_contents = [record_content for record_content in record_contents
+                           if (domain, record_content) in self._written]
+        if not record_contents:
+            logger.debug('No TXT record was written for %s, skipping cleanup', domain)
+            return
 
         try:
             zone = self._find_managed_zone(domain)
-            relative_record_name = ".".join(domain.split('.')[0:-len(zone.split('.'))])
+            relative_record_name = _relative_name(domain, zone)
 
             try:
                 record = self.dns_client.record_sets.get(self.resource_group, zone, relative_record_name, 'TXT')
-                record.txt_records = [tr for tr in record.txt_records if tr.value != [record_content]]
+                for record_content in record_contents:
+                    target = [record_content]
+                    for i, tr in enumerate(record.txt_records):
+                        if tr.value == target:
+                            del record.txt_records[i]
+                            break
             except azure.core.exceptions.ResourceNotFoundError:
                 return
 
@@ -179,7 +370,8 @@ class _AzureClient(object):
                     self.resource_group,
                     zone,
                     relative_record_name,
-                    'TXT'
+                    'TXT',
+                    if_match=record.etag
                 )
             else:
                 self.dns_client.record_sets.create_or_update(
@@ -187,9 +379,12 @@ class _AzureClient(object):
                     zone,
                     relative_record_name,
                     'TXT',
-                    record
+                    record,
+                    if_match=record.etag
                 )
-        except (CloudError, errors.PluginError) as e:
+
+            self._written.difference_update((domain, record_content) for record_content in record_contents)
+        except (azure.core.exceptions.HttpResponseError, errors.PluginError) as e:
             logger.warning('Encountered error deleting TXT record: %s', e)
 
     def _find_managed_zone(self, domain):
@@ -201,23 +396,24 @@ class _AzureClient(object):
         :rtype: str
         :raises certbot.errors.PluginError: if the managed zone cannot be found.
         """
-        try:
-            azure_zones = self.dns_client.zones.list()  # TODO - catch errors
-            azure_zones_list = []
-            while True:
-                for zone in azure_zones:
-                    azure_zones_list.append(zone.name)
-                azure_zones.next()
-        except StopIteration:
-            pass
-        except CloudError as e:
-            logger.error('Error finding zone: %s', e)
-            raise errors.PluginError('Error finding zone form the Azure DNS API: {0}'.format(e))
         zone_dns_name_guesses = dns_common.base_domain_name_guesses(domain)
 
-        for zone_name in zone_dns_name_guesses:
-            if zone_name in azure_zones_list:
-                return zone_name
+        for i, zone_name in enumerate(zone_dns_name_guesses):
+            if zone_name in self._zone_cache:
+                zone_name = self._zone_cache[zone_name]
+            else:
+                try:
+                    self.dns_client.zones.get(self.resource_group, zone_name)
+                except azure.core.exceptions.ResourceNotFoundError:
+                    continue
+                except azure.core.exceptions.HttpResponseError as e:
+                    logger.error('Error finding zone: %s', e)
+                    raise errors.PluginError('Error finding zone form the Azure DNS API: {0}'.format(e))
+
+            # Every name tried so far lives in the zone that was just found.
+            for name in zone_dns_name_guesses[:i + 1]:
+                self._zone_cache[name] = zone_name
+            return zone_name
 
         raise errors.PluginError(
             'Unable to determine managed zone for {0} using zone names: {1}.'
@@ -1,18 +1,22 @@
 """Tests for certbot_azure.authenticator."""
 
 import os
+import threading
 import unittest
 
 import mock
 import json
 
+import azure.core.exceptions
+from azure.mgmt.dns.models import RecordSet, TxtRecord
+
+from certbot import achallenges
 from certbot import errors
+from certbot import interfaces
 from certbot.plugins import dns_test_common_lexicon
-from certbot.plugins.dns_test_common import DOMAIN
+from certbot.plugins.dns_test_common import DOMAIN, KEY
+from certbot.tests import acme_util
 from certbot.tests import util as test_util
-from requests import Response
-
-from msrestazure.azure_exceptions import CloudError
 
 
 RESOURCE_GROUP = 'test-test-1'
@@ -35,21 +39,74 @@ class AuthenticatorTest(test_util.TempDirTestCase,
 
         self.mock_client = mock.MagicMock()
         # pylint: disable=protected-access
-        self.auth._get_azure_client = mock.MagicMock(return_value=self.mock_client)
+        self.auth._azure_client = self.mock_client
+
+    def test_plugin_interfaces(self):
+        from certbot_azure.dns_azure import Authenticator
+
+        self.assertTrue(interfaces.IPluginFactory.providedBy(Authenticator))
+        self.assertTrue(interfaces.IAuthenticator.implementedBy(Authenticator))
 
     def test_perform(self):
         self.auth.perform([self.achall])
 
-        expected = [mock.call.add_txt_record('_acme-challenge.'+DOMAIN, mock.ANY, mock.ANY)]
+        expected = [mock.call.add_txt_records('_acme-challenge.'+DOMAIN, [mock.ANY], mock.ANY)]
+        self.assertEqual(expected, self.mock_client.mock_calls)
+
+    def test_perform_single_name_inline(self):
+        threads = []
+        self.mock_client.add_txt_records.side_effect = lambda *args: threads.append(threading.current_thread())
+
+        self.auth.perform([self.achall])
+
+        self.assertEqual([threading.current_thread()], threads)
+
+    def test_perform_batched(self):
+        achall_2 = achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01_P_2, domain=DOMAIN, account_key=KEY)
+
+        responses = self.auth.perform([self.achall, achall_2])
+
+        expected = [mock.call.add_txt_records('_acme-challenge.'+DOMAIN,
+                                              [self.achall.validation(KEY), achall_2.validation(KEY)],
+                                              mock.ANY)]
         self.assertEqual(expected, self.mock_client.mock_calls)
+        self.assertEqual(2, len(responses))
+
+    def test_perform_multiple_names(self):
+        achall_2 = achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01_P_2, domain='sub.'+DOMAIN, account_key=KEY)
+
+        self.auth.perform([self.achall, achall_2])
+
+        expected = [mock.call.add_txt_records('_acme-challenge.'+DOMAIN, [mock.ANY], mock.ANY),
+                    mock.call.add_txt_records('_acme-challenge.sub.'+DOMAIN, [mock.ANY], mock.ANY)]
+        self.assertCountEqual(expected, self.mock_client.mock_calls)
+
+    def test_perform_error(self):
+        self.mock_client.add_txt_records.side_effect = errors.PluginError()
+
+        with self.assertRaises(errors.PluginError):
+            self.auth.perform([self.achall])
 
     def test_cleanup(self):
         # _attempt_cleanup | pylint: disable=protected-access
         self.auth._attempt_cleanup = True
         self.auth.cleanup([self.achall])
 
-        expected = [mock.call.del_txt_record('_acme-challenge.'+DOMAIN)]
+        expected = [mock.call.del_txt_records('_acme-challenge.'+DOMAIN, [mock.ANY]),
+                    mock.call.close()]
         self.assertEqual(expected, self.mock_client.mock_calls)
+        # pylint: disable=protected-access
+        self.assertIsNone(self.auth._azure_client)
+
+    def test_get_azure_client_cached(self):
+        # pylint: disable=protected-access
+        self.auth._azure_client = None
+
+        client = self.auth._get_azure_client()
+
+        self.assertIs(client, self.auth._get_azure_client())
 
 
 class AzureClientTest(test_util.TempDirTestCase):
@@ -58,10 +115,8 @@ class AzureClientTest(test_util.TempDirTestCase):
     record_content = "baz"
     record_ttl = 42
 
-    def _getCloudError(self):
-        response = Response()
-        response.status_code = 500
-        return CloudError(response)
+    def _getHttpResponseError(self):
+        return azure.core.exceptions.HttpResponseError(message='Internal Server Error')
 
     def setUp(self):
         from certbot_azure.dns_azure import _AzureClient
@@ -89,18 +144,59 @@ class AzureClientTest(test_util.TempDirTestCase):
                                         self.zone,
                                         self.record_name,
                                         'TXT',
-                                        mock.ANY)
+                                        mock.ANY,
+                                        if_none_match='*',
+                                        error_map=mock.ANY)
+        self.dns_client.record_sets.get.assert_not_called()
 
         record = self.dns_client.record_sets.create_or_update.call_args[0][4]
 
         self.assertEqual(self.record_ttl, record.ttl)
         self.assertEqual([self.record_content], record.txt_records[0].value)
 
+    def test_add_txt_records_one_entry_per_value(self):
+        # pylint: disable=protected-access
+        self.azure_client._find_managed_zone.return_value = self.zone
+
+        self.azure_client.add_txt_records(self.record_name + "." + self.zone,
+                                          [self.record_content, "qux"],
+                                          self.record_ttl)
+
+        record = self.dns_client.record_sets.create_or_update.call_args[0][4]
+
+        self.assertEqual([[self.record_content], ["qux"]], [tr.value for tr in record.txt_records])
+
+    def test_add_txt_record_existing(self):
+        # pylint: disable=protected-access
+        self.azure_client._find_managed_zone.return_value = self.zone
+
+        existing = RecordSet(ttl=self.record_ttl, txt_records=[TxtRecord(value=["qux"])])
+        existing.etag = "etag"
+        self.dns_client.record_sets.get.return_value = existing
+        self.dns_client.record_sets.create_or_update.side_effect = [
+            azure.core.exceptions.ResourceExistsError(),
+            None
+        ]
+
+        self.azure_client.add_txt_record(self.record_name + "." + self.zone,
+                                         self.record_content,
+                                         self.record_ttl)
+
+        self.dns_client.record_sets.create_or_update.assert_called_with(
+                                        self.azure_client.resource_group,
+                                        self.zone,
+                                        self.record_name,
+                                        'TXT',
+                                        existing,
+                                        if_match="etag")
+        self.assertEqual([["qux"], [self.record_content]],
+                         [tr.value for tr in existing.txt_records])
+
     def test_add_txt_record_error(self):
         # pylint: disable=protected-access
         self.azure_client._find_managed_zone.return_value = self.zone
 
-        self.dns_client.record_sets.create_or_update.side_effect = self._getCloudError()
+        self.dns_client.record_sets.create_or_update.side_effect = self._getHttpResponseError()
 
         with self.assertRaises(errors.PluginError):
             self.azure_client.add_txt_record(self.record_name + "." + self.zone,
@@ -111,7 +207,7 @@ class AzureClientTest(test_util.TempDirTestCase):
         # pylint: disable=protected-access
         self.azure_client._find_managed_zone.return_value = None
         # pylint: disable=protected-access
-        self.azure_client._find_managed_zone.side_effect = self._getCloudError()
+        self.azure_client._find_managed_zone.side_effect = self._getHttpResponseError()
 
         with self.assertRaises(errors.PluginError):
             self.azure_client.add_txt_record(self.record_name + "." + self.zone,
@@ -122,22 +218,184 @@ class AzureClientTest(test_util.TempDirTestCase):
         # pylint: disable=protected-access
         self.azure_client._find_managed_zone.return_value = self.zone
 
-        self.azure_client.del_txt_record(self.record_name + "." + self.zone)
+        existing = RecordSet(ttl=self.record_ttl, txt_records=[TxtRecord(value=[self.record_content])])
+        existing.etag = "etag"
+        self.dns_client.record_sets.get.return_value = existing
+
+        # pylint: disable=protected-access
+        self.azure_client._written.add((self.record_name + "." + self.zone, self.record_content))
+
+        self.azure_client.del_txt_record(self.record_name + "." + self.zone, self.record_content)
+
+        self.dns_client.record_sets.delete.assert_called_with(
+            self.azure_client.resource_group,
+            self.zone,
+            self.record_name,
+            'TXT',
+            if_match="etag")
+
+    def test_del_txt_records_keeps_others(self):
+        # pylint: disable=protected-access
+        self.azure_client._find_managed_zone.return_value = self.zone
+
+        existing = RecordSet(ttl=self.record_ttl, txt_records=[TxtRecord(value=["qux"]),
+                                                               TxtRecord(value=["quux"]),
+                                                               TxtRecord(value=[self.record_content])])
+        existing.etag = "etag"
+        self.dns_client.record_sets.get.return_value = existing
+
+        # pylint: disable=protected-access
+        self.azure_client._written.update([(self.record_name + "." + self.zone, "quux"),
+                                           (self.record_name + "." + self.zone, self.record_content)])
+
+        self.azure_client.del_txt_records(self.record_name + "." + self.zone, ["quux", self.record_content])
+
+        self.dns_client.record_sets.delete.assert_not_called()
+        self.dns_client.record_sets.create_or_update.assert_called_once_with(
+                                        self.azure_client.resource_group,
+                                        self.zone,
+                                        self.record_name,
+                                        'TXT',
+                                        existing,
+                                        if_match="etag")
+        self.assertEqual([["qux"]], [tr.value for tr in existing.txt_records])
 
-        self.dns_client.record_sets.delete.assert_called_with(self.azure_client.resource_group,
-                                                              self.zone,
-                                                              self.record_name,
-                                                              'TXT')
     def test_del_txt_record_no_zone(self):
         # pylint: disable=protected-access
         self.azure_client._find_managed_zone.return_value = None
         # pylint: disable=protected-access
-        self.azure_client._find_managed_zone.side_effect = self._getCloudError()
+        self.azure_client._find_managed_zone.side_effect = self._getHttpResponseError()
+        self.azure_client._written.add((self.record_name + "." + self.zone, self.record_content))
 
-        self.azure_client.del_txt_record(self.record_name + "." + self.zone)
+        self.azure_client.del_txt_record(self.record_name + "." + self.zone, self.record_content)
 
         self.dns_client.record_sets.delete.assert_not_called()
 
+    def test_del_txt_record_not_written(self):
+        self.azure_client.del_txt_record(self.record_name + "." + self.zone, self.record_content)
+
+        # pylint: disable=protected-access
+        self.azure_client._find_managed_zone.assert_not_called()
+        self.dns_client.record_sets.get.assert_not_called()
+
+    def test_add_then_del_txt_record(self):
+        # pylint: disable=protected-access
+        self.azure_client._find_managed_zone.return_value = self.zone
+        self.dns_client.record_sets.get.return_value = RecordSet(
+            ttl=self.record_ttl, txt_records=[TxtRecord(value=[self.record_content])])
+
+        self.azure_client.add_txt_record(self.record_name + "." + self.zone,
+                                         self.record_content,
+                                         self.record_ttl)
+        self.azure_client.del_txt_record(self.record_name + "." + self.zone, self.record_content)
+
+        self.dns_client.record_sets.delete.assert_called_once()
+        self.assertFalse(self.azure_client._written)
+
+    def test_find_managed_zone(self):
+        # pylint: disable=protected-access
+        del self.azure_client._find_managed_zone
+        self.dns_client.zones.get.side_effect = [
+            azure.core.exceptions.ResourceNotFoundError(),
+            mock.MagicMock()
+        ]
+
+        zone = self.azure_client._find_managed_zone(self.record_name + "." + self.zone)
+
+        self.assertEqual(self.zone, zone)
+        self.dns_client.zones.get.assert_called_with(self.azure_client.resource_group, self.zone)
+        self.dns_client.zones.list.assert_not_called()
+
+    def test_find_managed_zone_cached(self):
+        # pylint: disable=protected-access
+        del self.azure_client._find_managed_zone
+        self.dns_client.zones.get.side_effect = [
+            azure.core.exceptions.ResourceNotFoundError(),
+            azure.core.exceptions.ResourceNotFoundError(),
+            mock.MagicMock(),
+            azure.core.exceptions.ResourceNotFoundError()
+        ]
+
+        self.azure_client._find_managed_zone("_acme-challenge." + self.record_name + "." + self.zone)
+        self.azure_client._find_managed_zone("_acme-challenge." + self.record_name + "." + self.zone)
+        zone = self.azure_client._find_managed_zone("qux." + self.record_name + "." + self.zone)
+
+        self.assertEqual(self.zone, zone)
+        self.assertEqual(4, self.dns_client.zones.get.call_count)
+
+    def test_find_managed_zone_not_found(self):
+        # pylint: disable=protected-access
+        del self.azure_client._find_managed_zone
+        self.dns_client.zones.get.side_effect = azure.core.exceptions.ResourceNotFoundError()
+
+        with self.assertRaises(errors.PluginError):
+            self.azure_client._find_managed_zone(self.record_name + "." + self.zone)
+
+    def test_find_managed_zone_error(self):
+        # pylint: disable=protected-access
+        del self.azure_client._find_managed_zone
+        self.dns_client.zones.get.side_effect = self._getHttpResponseError()
+
+        with self.assertRaises(errors.PluginError):
+            self.azure_client._find_managed_zone(self.record_name + "." + self.zone)
+
+    def test_pooled_transport(self):
+        from certbot_azure.dns_azure import _AzureClient, MAX_WORKERS
+
+        config_path = AzureClientConfigDummy.build_config(self.tempdir)
+
+        with mock.patch('certbot_azure.dns_azure.DnsManagementClient') as dns_client_class:
+            _AzureClient(RESOURCE_GROUP, config_path)
+
+        transport = dns_client_class.call_args[1]['transport']
+        adapter = transport.session.get_adapter('https://management.azure.com/')
+        self.assertEqual(MAX_WORKERS, adapter._pool_maxsize)  # pylint: disable=protected-access
+        self.assertEqual(3, adapter.max_retries.total)
+
+    def test_close(self):
+        with self.azure_client as client:
+            self.assertIs(self.azure_client, client)
+
+        self.dns_client.close.assert_called_once_with()
+
+
+class LoadAccountJsonTest(test_util.TempDirTestCase):
+
+    def test_load_account_json_cached(self):
+        from certbot_azure.dns_azure import _load_account_json
+
+        config_path = AzureClientConfigDummy.build_config(self.tempdir)
+
+        account_json = _load_account_json(config_path)
+
+        self.assertEqual('uuid', account_json['clientId'])
+        self.assertEqual('https://management.azure.com/', account_json['_base_url'])
+        self.assertEqual(('https://management.azure.com//.default',), account_json['_credential_scopes'])
+        self.assertIs(account_json, _load_account_json(config_path))
+
+    def test_load_account_json_reloads_on_change(self):
+        from certbot_azure.dns_azure import _load_account_json
+
+        config_path = AzureClientConfigDummy.build_config(self.tempdir)
+        account_json = _load_account_json(config_path)
+
+        with open(config_path, 'w') as outfile:
+            json.dump({"clientId": "rotated", "resourceManagerEndpointUrl": "https://example.com/"}, outfile)
+        stat = os.stat(config_path)
+        os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+        self.assertEqual('rotated', _load_account_json(config_path)['clientId'])
+        self.assertEqual('uuid', account_json['clientId'])
+
+
+class RelativeNameTest(unittest.TestCase):
+
+    def test_relative_name(self):
+        from certbot_azure.dns_azure import _relative_name
+
+        self.assertEqual('_acme-challenge.bar', _relative_name('_acme-challenge.bar.foo.com', 'foo.com'))
+        self.assertEqual('_acme-challenge', _relative_name('_acme-challenge.foo.com', 'foo.com'))
+
 
 class AzureClientConfigDummy(object):
     """Helper class to create dummy Azure configuration"""
@@ -14,6 +14,7 @@ install_requires = [
     'azure-mgmt-dns>=3.0.0',
     'msrestazure',
     'PyOpenSSL>=19.1.0',
+    'requests',
     'setuptools',  # pkg_resources
     'zope.interface'
 ]